@@ -6,9 +6,18 @@ from time import sleep, time, gmtime
 from datetime import datetime
 from calendar import timegm
 import os
-import re
 import argparse
+import fcntl
+import tempfile
+import json
+import threading
 import yaml
+from popup_keywords import KeywordMatcher
+
+try:
+    from urllib2 import Request, urlopen
+except ImportError:
+    from urllib.request import Request, urlopen
 
 try:
     from kphs.cloudwatch_metrics_helper import send_or_create_metric_data
@@ -36,19 +45,276 @@ DEFAULT_REGION = 'us-west-2'
 
 TIMEOUT_DURATION = 300
 
+# Resource ids showing the app switcher (recents) screen is up, across AOSP, Pixel and OEM launchers
+RECENTS_MARKERS = [
+    ":id/recents",
+    ":id/overview_panel",
+    ":id/task_view",
+    ":id/snapshot",
+]
+
+# Keyboards whose data we clear before each walkthrough so their first-run popups show up again
+KEYBOARD_PACKAGES = [
+    "com.google.android.inputmethod.latin",
+    "com.google.android.apps.inputmethod.hindi",
+    "com.sec.android.inputmethod",
+]
+
+class BackgroundTask(threading.Thread):
+    """
+    Runs a function on a daemon thread so independent work can overlap with UI stages.
+    Call wait() only when a later step actually depends on the result; it re-raises any
+    exception the function hit.
+    """
+
+    def __init__(self, name, function, *args):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.function = function
+        self.args = args
+        self.result = None
+        self.error = None
+        self.duration = None
+
+    def run(self):
+        start = time()
+        try:
+            self.result = self.function(*self.args)
+        except Exception as e:
+            self.error = e
+        self.duration = time() - start
+
+    @classmethod
+    def start_new(cls, name, function, *args):
+        task = cls(name, function, *args)
+        task.start()
+        return task
+
+    def wait(self, timeout=None):
+        self.join(timeout)
+        if self.is_alive():
+            raise RuntimeError("%s did not finish within %s seconds"%(self.name, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class BatchedSelectorQuery:
+    """
+    Collects several selector lookups against a uiautomator Device and sends them to the on-device
+    server as a single JSON-RPC batch request, instead of one HTTP round trip per lookup.
+    Each add method returns an index into the list returned by execute(). Lookups that fail on the
+    server (e.g. objInfo on a selector that matches nothing) come back as None.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.calls = []
+
+    def _add(self, method, selector_kwargs):
+        self.calls.append((method, self.device(**selector_kwargs).selector))
+        return len(self.calls) - 1
+
+    def exists(self, **kwargs):
+        return self._add("exist", kwargs)
+
+    def info(self, **kwargs):
+        return self._add("objInfo", kwargs)
+
+    def info_of_all_instances(self, **kwargs):
+        return self._add("objInfoOfAllInstances", kwargs)
+
+    def execute(self, timeout=90):
+        """
+        Send every collected lookup in one request and return the results in the order they were added.
+        Falls back to one call per lookup if the batch request itself fails.
+        """
+        results = [None] * len(self.calls)
+        if not self.calls:
+            return results
+        payload = [{"jsonrpc": "2.0", "method": method, "params": [selector], "id": i}
+            for i, (method, selector) in enumerate(self.calls)]
+        try:
+            request = Request(self.device.server.rpc_uri, json.dumps(payload).encode("utf-8"),
+                {"Content-type": "application/json"})
+            response = json.loads(urlopen(request, timeout=timeout).read().decode("utf-8"))
+            for entry in response:
+                if not entry.get("error"):
+                    results[entry["id"]] = entry.get("result")
+        except Exception as e:
+            print("Batched selector query failed, falling back to single calls:", type(e), e)
+            for i, (method, selector) in enumerate(self.calls):
+                try:
+                    results[i] = getattr(self.device.server.jsonrpc, method)(selector)
+                except JsonRPCError:
+                    results[i] = None
+        return results
+
+    @staticmethod
+    def right_of(info, candidates):
+        """
+        Mirrors uiautomator's right(...): returns the info of the closest candidate to the right of
+        info that overlaps it vertically, or None. Candidates come from info_of_all_instances.
+        """
+        if not info or not candidates:
+            return None
+        bounds = info["bounds"]
+        min_dist, found = -1, None
+        for candidate in candidates:
+            other = candidate["bounds"]
+            if max(bounds["top"], other["top"]) >= min(bounds["bottom"], other["bottom"]):
+                continue
+            dist = other["left"] - bounds["right"]
+            if dist >= 0 and (min_dist < 0 or dist < min_dist):
+                min_dist, found = dist, candidate
+        return found
+
+class StagePlanner:
+    """
+    Plans the order and retry budget of the walkthrough stages from historical per-stage outcomes
+    for this device model and build, stored in a YAML history file shaped like:
+        model:
+          build:
+            stage: {runs: 12, failures: 1, empty_runs: 11, retried_passes: 0, total_duration: 40.2}
+    Build-level stats are used once there are enough runs, otherwise the model-wide ones.
+    Until every stage has min_runs of history the default order is kept, and a stage without
+    min_runs of history gets one attempt and no fast path.
+    Runs sharing a history file add their own counts to it on save, under a lock, and the file is
+    replaced atomically so readers never see it half written.
+    """
+
+    min_runs = 5
+    default_duration = 10.0
+    usually_empty_rate = 0.9
+    retry_failure_rate_range = (0.2, 0.8)
+
+    def __init__(self, history_file, model, build):
+        self.history_file = history_file
+        self.model = model
+        self.build = build
+        # this run's counts, added to whatever is in the file when it's saved
+        self.run_stats = {}
+        self.history = {}
+        if history_file and os.path.isfile(history_file):
+            try:
+                self.history = self._load()
+            except Exception as e:
+                print("Couldn't read stage history, using the default plan:", type(e), e)
+
+    def _load(self):
+        if not os.path.isfile(self.history_file):
+            return {}
+        with open(self.history_file) as f:
+            return yaml.safe_load(f) or {}
+
+    def _stats(self, stage):
+        model_history = self.history.get(self.model, {})
+        build_stats = model_history.get(self.build, {}).get(stage, {})
+        if build_stats.get("runs", 0) >= self.min_runs:
+            return build_stats
+        model_stats = {}
+        for build_history in model_history.values():
+            for key, value in build_history.get(stage, {}).items():
+                model_stats[key] = model_stats.get(key, 0) + value
+        return model_stats
+
+    def failure_rate(self, stage):
+        stats = self._stats(stage)
+        # Laplace smoothing so a handful of runs doesn't pin a stage at 0 or 1
+        return (stats.get("failures", 0) + 1.0) / (stats.get("runs", 0) + 2.0)
+
+    def expected_duration(self, stage):
+        stats = self._stats(stage)
+        if not stats.get("runs"):
+            return self.default_duration
+        return max(stats.get("total_duration", 0) / float(stats["runs"]), 0.1)
+
+    def order(self, stage_groups):
+        """
+        Orders groups of dependent stages so the likeliest failure per second of runtime goes first.
+        Every stage must pass and the walkthrough stops at the first failure, so this minimizes the
+        expected runtime. Stages within a group keep their order. Groups keep their given order
+        unless every stage in them has at least min_runs of history.
+        """
+        if any(self._stats(stage).get("runs", 0) < self.min_runs for group in stage_groups for stage in group):
+            return list(stage_groups)
+        def score(group):
+            pass_chance = 1.0
+            for stage in group:
+                pass_chance *= 1 - self.failure_rate(stage)
+            return (1 - pass_chance) / sum(self.expected_duration(stage) for stage in group)
+        return sorted(stage_groups, key=score, reverse=True)
+
+    def is_usually_empty(self, stage):
+        stats = self._stats(stage)
+        return (stats.get("runs", 0) >= self.min_runs and
+            stats.get("empty_runs", 0) >= self.usually_empty_rate * stats["runs"])
+
+    def attempts(self, stage):
+        """
+        Gives a second attempt to stages that fail intermittently or that have passed on a retry before
+        """
+        stats = self._stats(stage)
+        if stats.get("runs", 0) < self.min_runs:
+            return 1
+        low, high = self.retry_failure_rate_range
+        if stats.get("retried_passes", 0) or low <= self.failure_rate(stage) <= high:
+            return 2
+        return 1
+
+    def _add(self, history, stage, counts):
+        stats = history.setdefault(self.model, {}).setdefault(self.build, {}).setdefault(stage, {})
+        for key, value in counts.items():
+            stats[key] = stats.get(key, 0) + value
+
+    def record(self, stage, passed, duration, steps, attempts):
+        counts = {"runs": 1, "failures": 0 if passed else 1,
+            "empty_runs": 1 if passed and not steps else 0,
+            "retried_passes": 1 if passed and attempts > 1 else 0,
+            "total_duration": duration}
+        self._add(self.history, stage, counts)
+        run_stats = self.run_stats.setdefault(stage, {})
+        for key, value in counts.items():
+            run_stats[key] = run_stats.get(key, 0) + value
+
+    def save(self):
+        """
+        Adds this run's counts to the history file as it is now, so concurrent runs don't overwrite
+        each other, and swaps the new file into place with a rename
+        """
+        if not self.history_file or not self.run_stats:
+            return
+        with open(self.history_file + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                history = self._load()
+                for stage, counts in self.run_stats.items():
+                    self._add(history, stage, counts)
+                handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.history_file)))
+                with os.fdopen(handle, "w") as f:
+                    yaml.safe_dump(history, f, default_flow_style=False)
+                os.chmod(temp_path, 0o644)
+                os.rename(temp_path, self.history_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.history = history
+        self.run_stats = {}
+
 class OneTimePopupHandler:
 
     verbose = False
     output_dir = None
     timeout_duration = 300
     retries = 1
-    cloudwatch_metrics = {}
-    popup_handling_steps = {}
+    teardown_timeout = 60
+    device_preparation_timeout = 60
+    # stages that bring up their own screen again, so running them a second time is safe
+    retriable_stages = ["initial_popups", "camera_prompts", "app_switcher_popups"]
     log_group_name_and_namespace = "PopupHandler"
     log_stream_name = "Results"
     stage = "gamma"
-    start_time_int = timegm(gmtime()) * 1000
-    start_time = str(datetime.now())
+    history_file = None
+    # keywords is the KeywordMatcher for the device's language, built once per session
+    keywords = None
     
 
     # d is the uiautomator Device corresponding to this handler
@@ -68,6 +334,10 @@ class OneTimePopupHandler:
             help="timeout for the dismissal in seconds")
         parser.add_argument("-r", "--retries", type=int, default=1,
             help="retries on performing walkthrough")
+        parser.add_argument("--history-file", dest="history_file", type=str,
+            help="YAML file of per-model stage outcomes used to order, fast-path and retry stages")
+        parser.add_argument("--teardown-timeout", type=int, dest="teardown_timeout", default=60,
+            help="seconds to wait for device cleanup, metrics and log upload at the end of the run")
         args = parser.parse_args(argv[1:])
         for arg in vars(args):
             setattr(self, arg, getattr(args, arg))
@@ -88,26 +358,106 @@ class OneTimePopupHandler:
 
     # Create a uiautomator Device when we create a OneTimePopupHandler object
     def __init__(self):
-        self.initialize_device()
+        self.closed = True
+        self.open()
+
+    def open(self):
+        """
+        Starts a session on the device with fresh per-run state, so a closed handler can be reused
+        """
+        self.cloudwatch_metrics = {}
+        self.popup_handling_steps = {}
+        self.start_time_int = timegm(gmtime()) * 1000
+        self.start_time = str(datetime.now())
+        self.planner = None
+        self.device_preparation = None
+        self.teardown_report = {}
+        try:
+            self.initialize_device()
+            self.keywords = KeywordMatcher.for_device()
+            if self.verbose:
+                print("Matching popup text in English and '%s'"%self.keywords.language)
+            if self.verbose:
+                self.dump_screen_information("starting_screen")
+            if CLOUDWATCH_IMPORTED:
+                ensure_log_group_exists(self.log_group_name_and_namespace)
+        except Exception:
+            # close() never runs if we raise out of here, so leave the device as we found it
+            try:
+                self.clean_up_device()
+            except Exception as e:
+                print("Couldn't clean up the device after failing to start:", type(e), e)
+            raise
+        self.closed = False
+
+    def __enter__(self):
+        if self.closed:
+            self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        Ends the session: cleans up the device, writes the local files and sends metrics and logs.
+        Device cleanup, local files and metrics run concurrently, the S3 upload starts once the local
+        files are written, and the whole teardown is bounded by teardown_timeout seconds.
+        Returns a report of how long each piece took, which is also printed. Safe to call twice.
+        """
+        if self.closed:
+            return self.teardown_report
+        self.closed = True
+        start = time()
+        deadline = start + self.teardown_timeout
+        # the ending screen goes in the uploaded logs and needs uiautomator, so it comes first
         if self.verbose:
-            self.dump_screen_information("starting_screen")
+            try:
+                self.dump_screen_information("ending_screen")
+            except Exception as e:
+                print("Couldn't capture the ending screen:", type(e), e)
+        # pm clear must not still be running when uiautomator gets uninstalled
+        self.finish_device_preparation(max(deadline - time(), 0))
+        tasks = [BackgroundTask.start_new("device_cleanup", self.clean_up_device),
+            BackgroundTask.start_new("local_files", self.finalize_local_files)]
+        self.teardown_report = {}
         if CLOUDWATCH_IMPORTED:
-            ensure_log_group_exists(self.log_group_name_and_namespace)
+            tasks.append(BackgroundTask.start_new("metrics", self.send_metrics))
+            if self.output_dir:
+                # only upload complete files
+                tasks[1].join(max(deadline - time(), 0))
+                if not tasks[1].is_alive() and tasks[1].error is None:
+                    tasks.append(BackgroundTask.start_new("upload", self.upload_logs))
+                else:
+                    self.teardown_report["upload"] = "skipped: local files weren't finalized"
 
-    # Delete the uiautomator Device when we delete a OneTimePopupHandler object,
-    # and uninstall any added packages from the device
-    def __del__(self):
-        if self.verbose:
-            self.dump_screen_information("ending_screen")
+        for task in tasks:
+            try:
+                task.wait(max(deadline - time(), 0))
+                self.teardown_report[task.name] = "%.2fs"%task.duration
+            except Exception as e:
+                self.teardown_report[task.name] = "failed: %s %s"%(type(e), e)
+        self.teardown_report["total"] = "%.2fs"%(time() - start)
+        print("Teardown timings: %s"%", ".join("%s: %s"%(name, result)
+            for name, result in sorted(self.teardown_report.items())))
+        return self.teardown_report
+
+    def clean_up_device(self):
+        """
+        Drops the uiautomator Device, uninstalls the packages it added and goes back to the home screen
+        """
         self.d = None
         for command in [["adb", "uninstall", "com.github.uiautomator"],
             ["adb", "uninstall", "com.github.uiautomator.test"],
             ["adb", "shell", "am", "start", "-a", "android.intent.action.MAIN",
                 "-c", "android.intent.category.HOME"]]:
-            try:
-                call(command)
-            except Exception:
-                pass
+            call(command)
+
+    def finalize_local_files(self):
+        """
+        Writes the dismissed popups and the stage history, and opens up permissions on the output dir
+        """
         class ExtraSpacingDumper(yaml.SafeDumper):
 
             def increase_indent(self, flow=False, indentless=True):
@@ -119,20 +469,23 @@ class OneTimePopupHandler:
                     Dumper=ExtraSpacingDumper, default_flow_style=False,
                     width=200, stream=s)
 
-        call(["chmod", "-R", "777", self.output_dir])
-        if CLOUDWATCH_IMPORTED:
-            if self.popup_handling_steps:
-                self.cloudwatch_metrics["ObservedPopups"] = len(set(self.popup_handling_steps).union(
-                    set([x.split("Failed_")[1] for x in self.cloudwatch_metrics if "Failed_" in x])))
-                self.cloudwatch_metrics["DismissedPopups"] = self.cloudwatch_metrics["ObservedPopups"] - len(
-                    [x.split("Failed_")[1] for x in self.cloudwatch_metrics if "Failed_" in x])
-            else:
-                self.cloudwatch_metrics["DismissedPopups"] = 0
-                self.cloudwatch_metrics["ObservedPopups"] = 0
-            for key, value in self.cloudwatch_metrics.items():
-                send_or_create_metric_data(self.log_group_name_and_namespace, key, value)
-            self.upload_logs()
+        if self.planner:
+            self.planner.save()
 
+        if self.output_dir:
+            call(["chmod", "-R", "777", self.output_dir])
+
+    def send_metrics(self):
+        if self.popup_handling_steps:
+            self.cloudwatch_metrics["ObservedPopups"] = len(set(self.popup_handling_steps).union(
+                set([x.split("Failed_")[1] for x in self.cloudwatch_metrics if "Failed_" in x])))
+            self.cloudwatch_metrics["DismissedPopups"] = self.cloudwatch_metrics["ObservedPopups"] - len(
+                [x.split("Failed_")[1] for x in self.cloudwatch_metrics if "Failed_" in x])
+        else:
+            self.cloudwatch_metrics["DismissedPopups"] = 0
+            self.cloudwatch_metrics["ObservedPopups"] = 0
+        for key, value in self.cloudwatch_metrics.items():
+            send_or_create_metric_data(self.log_group_name_and_namespace, key, value)
 
     def dump_screen_information(self, name, dump=None):
         """
@@ -189,6 +542,15 @@ class OneTimePopupHandler:
         self.save_popup_walkthrough(name, step.info)
         step.click.wait()
 
+    def perform_popup_step_from_info(self, name, info):
+        """
+        Same as perform_popup_step, for a view whose info was already fetched (e.g. by a
+        BatchedSelectorQuery): clicks the centre of its bounds instead of looking it up again
+        """
+        self.save_popup_walkthrough(name, info)
+        bounds = info["bounds"]
+        self.d.click((bounds["left"] + bounds["right"]) // 2, (bounds["top"] + bounds["bottom"]) // 2)
+
     def dismiss_any_sporadic_popups(self):
         """
         This is a direct python conversion of our TestAndroidPopUps.java file, ment to accomplish the same task.
@@ -197,16 +559,15 @@ class OneTimePopupHandler:
             print("Handling initial sporadic popups")
             self.dump_screen_information("handling_sporadic_popups")
         popup_selectors = {
-            "safeSimSelector": {"textMatches": ".*(?i)\\b(sim|mobile data)\\b.*"},
-            "unfortunatelySelector": {"textStartsWith": "Unfortunately"},
-            "notRespondingSelector": {"textContains": "responding"},
-            "safeWhitelistSelector": {"textMatches": ".*(?i)\\b(attention|hands free activation|multi window|select home|update firmware)\\b.*"},
-            "negatorySelector": {"clickable": True, "textMatches": ".*(?i)\\b(cancel|later|no|deny|decline|skip|close app|don't send|block|just once)\\b.*"},
-            "affirmatorySelector": {"clickable": True, "textMatches": ".*(?i)\\b(ok|okay|yes|start|accept|allow)\\b.*"},
-            "affirmatorySelectorFalsePositive": {"clickable": True, "textMatches": ".*(?i)\\b(autostart)\\b.*"},
-            "softwareUpdateSelector": {"textMatches": 
-                ".*(?i)\\b(install overnight|download|yes, i'm in|install|install now|software update|software upgrade|system upgrade|system update|system software)\\b.*"},
-            "doNotShowAgainSelector": {"clickable": True, "textMatches": "(?i)(do not|don't) show again"},
+            "safeSimSelector": {"textMatches": self.keywords.pattern("sim")},
+            "unfortunatelySelector": {"textMatches": self.keywords.pattern("unfortunately")},
+            "notRespondingSelector": {"textMatches": self.keywords.pattern("not_responding")},
+            "safeWhitelistSelector": {"textMatches": self.keywords.pattern("system_popup")},
+            "negatorySelector": {"clickable": True, "textMatches": self.keywords.pattern("negatory")},
+            "affirmatorySelector": {"clickable": True, "textMatches": self.keywords.pattern("affirmatory")},
+            "affirmatorySelectorFalsePositive": {"clickable": True, "textMatches": self.keywords.pattern("autostart")},
+            "softwareUpdateSelector": {"textMatches": self.keywords.pattern("software_update")},
+            "doNotShowAgainSelector": {"clickable": True, "textMatches": self.keywords.pattern("do_not_show_again")},
         }
         def dont_show_again():
             if (self.d(**popup_selectors["doNotShowAgainSelector"]).exists and
@@ -244,39 +605,51 @@ class OneTimePopupHandler:
         self.dump_screen_information("failed_to_dismiss_sporadic_popups")
         return False
 
-    def trigger_and_handle_app_switch_popup(self):
+    def trigger_and_handle_app_switch_popup(self, fast_path=False):
         """
         Triggers and handles the popup explaining how the app switcher works
         Uses screen dumps as an optimization in some cases instead of selector calls
+        With fast_path, polls for the app switcher or its tutorial instead of always waiting 3 seconds
         """
         self.d.press(0xbb)
-        sleep(3)
+        if fast_path:
+            deadline = time() + 3
+            while time() < deadline:
+                screen_dump = self.d.dump()
+                if (any(marker in screen_dump for marker in RECENTS_MARKERS) or
+                    screen_dump.find('class="android.widget.CheckBox"') != -1 or
+                    self.keywords.in_dump(screen_dump, "ok", "next")):
+                    break
+                sleep(0.5)
+        else:
+            sleep(3)
         if self.verbose:
             print("Handling app switcher initial prompts")
             self.dump_screen_information("handling_app_switcher_prompts")
         for i in range(4):
             screen_dump = self.d.dump()
             if ((screen_dump.find('class="android.widget.CheckBox"') != -1) and
-                self.d(className="android.widget.CheckBox", textMatches=".*(?i)\\b(do not).*").exists and
-                not self.d(className="android.widget.CheckBox", textMatches=".*(?i)\\b(do not).*").checked):
-                self.perform_popup_step("app_switcher_popups", self.d(className="android.widget.CheckBox", textContains="Do not"))
-            if re.search('text=".*(?i)\\b(ok).*"', screen_dump) and self.d(textMatches=".*(?i)\\b(ok).*").exists:
-                self.perform_popup_step("app_switcher_popups", self.d(textMatches=".*(?i)\\b(ok).*"))
-            elif re.search('text=".*(?i)\\b(next).*"', screen_dump) and self.d(textMatches=".*(?i)\\b(next).*").exists:
-                self.perform_popup_step("app_switcher_popups", self.d(textMatches=".*(?i)\\b(next).*"))
+                self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")).exists and
+                not self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")).checked):
+                self.perform_popup_step("app_switcher_popups",
+                    self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")))
+            if self.keywords.in_dump(screen_dump, "ok") and self.d(textMatches=self.keywords.pattern("ok")).exists:
+                self.perform_popup_step("app_switcher_popups", self.d(textMatches=self.keywords.pattern("ok")))
+            elif self.keywords.in_dump(screen_dump, "next") and self.d(textMatches=self.keywords.pattern("next")).exists:
+                self.perform_popup_step("app_switcher_popups", self.d(textMatches=self.keywords.pattern("next")))
             else:
                 break
-        if re.search('text=".*(?i)\\b(close).*"', screen_dump) and self.d(textMatches=".*(?i)\\b(close).*").exists:
-            self.d(textMatches=".*(?i)\\b(close).*").click()
+        if self.keywords.in_dump(screen_dump, "close") and self.d(textMatches=self.keywords.pattern("close")).exists:
+            self.d(textMatches=self.keywords.pattern("close")).click()
             screen_dump = self.d.dump()
-        if re.search('text=".*(?i)\\b(clear).*"', screen_dump) and self.d(textMatches=".*(?i)\\b(clear).*").exists:
-            self.d(textMatches=".*(?i)\\b(clear).*").click()
+        if self.keywords.in_dump(screen_dump, "clear") and self.d(textMatches=self.keywords.pattern("clear")).exists:
+            self.d(textMatches=self.keywords.pattern("clear")).click()
             screen_dump = self.d.dump()
         if self.verbose:
             print("Handled app switcher initial prompts")
             self.dump_screen_information("handled_app_switcher_prompts", dump=screen_dump)
         success=False
-        if not re.search('text=".*(?i)\\b(ok).*"', screen_dump) and not re.search('text=".*(?i)\\b(next).*"', screen_dump):
+        if not self.keywords.in_dump(screen_dump, "ok", "next"):
             self.cloudwatch_metrics["Passed_app_switcher_popups"] = 1
             if self.verbose:
                 print("Handled app switcher popups just fine")
@@ -293,9 +666,11 @@ class OneTimePopupHandler:
         self.d.press.back()
         return success
 
-    def trigger_and_handle_camera_popups(self):
+    def trigger_and_handle_camera_popups(self, fast_path=False):
         """
         Triggers and handles the popup explaining how the camera works
+        With fast_path, a single screen dump is checked after the sporadic popups are dismissed, and
+        the stage passes straight away if none of its prompts are showing
         """
         if self.verbose:
             print("Handling camera initial prompts")
@@ -303,25 +678,31 @@ class OneTimePopupHandler:
         call(["adb", "shell", "am", "start", "-a",
             "android.media.action.IMAGE_CAPTURE"])
         sleep(1)
+        # permission and other system dialogs have no ok/next/done text, so clear them before probing
         self.dismiss_any_sporadic_popups()
-        if self.d(className="android.widget.Button", textMatches=".*(?i)\\b(ok).*").exists:
-            self.perform_popup_step("camera_prompts", self.d(className="android.widget.Button", textMatches=".*(?i)\\b(ok).*"))
-        if self.d(textMatches=".*(?i)\\b(next).*").exists:
-            self.perform_popup_step("camera_prompts", self.d(textMatches=".*(?i)\\b(next).*"))
-            if self.d(textMatches=".*(?i)\\b(next).*").exists:
-                self.perform_popup_step("camera_prompts", self.d(textMatches=".*(?i)\\b(next).*"))
-            if self.d(textMatches=".*(?i)\\b(ok).*").exists:
-                self.perform_popup_step("camera_prompts", self.d(textMatches=".*(?i)\\b(ok).*"))
-            elif self.d(textMatches=".*(?i)\\b(done).*").exists:
-                self.perform_popup_step("camera_prompts", self.d(textMatches=".*(?i)\\b(done).*"))
-        if self.d(textMatches=".*(?i)\\b(ok).*").exists:
-            self.perform_popup_step("camera_prompts", self.d(textMatches=".*(?i)\\b(ok).*"))
+        if fast_path and not self.keywords.in_dump(self.d.dump(), "ok", "next", "done"):
+            self.cloudwatch_metrics["Passed_camera_prompts"] = 1
+            if self.verbose:
+                print("No camera prompts showing, skipped handling them")
+            return True
+        if self.d(className="android.widget.Button", textMatches=self.keywords.pattern("ok")).exists:
+            self.perform_popup_step("camera_prompts", self.d(className="android.widget.Button", textMatches=self.keywords.pattern("ok")))
+        if self.d(textMatches=self.keywords.pattern("next")).exists:
+            self.perform_popup_step("camera_prompts", self.d(textMatches=self.keywords.pattern("next")))
+            if self.d(textMatches=self.keywords.pattern("next")).exists:
+                self.perform_popup_step("camera_prompts", self.d(textMatches=self.keywords.pattern("next")))
+            if self.d(textMatches=self.keywords.pattern("ok")).exists:
+                self.perform_popup_step("camera_prompts", self.d(textMatches=self.keywords.pattern("ok")))
+            elif self.d(textMatches=self.keywords.pattern("done")).exists:
+                self.perform_popup_step("camera_prompts", self.d(textMatches=self.keywords.pattern("done")))
+        if self.d(textMatches=self.keywords.pattern("ok")).exists:
+            self.perform_popup_step("camera_prompts", self.d(textMatches=self.keywords.pattern("ok")))
         if self.verbose:
             print("Handled camera initial prompts")
             self.dump_screen_information("handled_camera_prompts")
-        if (not self.d(textMatches=".*(?i)\\b(ok).*").exists and
-            not self.d(textMatches=".*(?i)\\b(next).*").exists and
-            not self.d(textMatches=".*(?i)\\b(done).*").exists):
+        if (not self.d(textMatches=self.keywords.pattern("ok")).exists and
+            not self.d(textMatches=self.keywords.pattern("next")).exists and
+            not self.d(textMatches=self.keywords.pattern("done")).exists):
             self.cloudwatch_metrics["Passed_camera_prompts"] = 1
             if self.verbose:
                 print("Handled camera prompts just fine")
@@ -356,18 +737,18 @@ class OneTimePopupHandler:
         if ((screen_dump.find('class="android.widget.CheckBox"') != -1) and not
             self.d(className="android.widget.CheckBox").checked):
             self.perform_popup_step("initial_popups", self.d(className="android.widget.CheckBox"))
-        if re.search('text=".*(?i)\\b(ok).*"', screen_dump) and self.d(textMatches=".*(?i)\\b(ok).*").exists:
-            self.perform_popup_step("initial_popups", self.d(textMatches=".*(?i)\\b(ok).*"))
+        if self.keywords.in_dump(screen_dump, "ok") and self.d(textMatches=self.keywords.pattern("ok")).exists:
+            self.perform_popup_step("initial_popups", self.d(textMatches=self.keywords.pattern("ok")))
             screen_dump = self.d.dump()
-        if re.search('text=".*(?i)\\b(next).*"', screen_dump) and self.d(textMatches=".*(?i)\\b(next).*").exists:
-            self.perform_popup_step("initial_popups", self.d(textMatches=".*(?i)\\b(next).*"))
-            if self.d(textMatches=".*(?i)\\b(ok).*").exists:
-                self.perform_popup_step("initial_popups", self.d(textMatches=".*(?i)\\b(ok).*"))
+        if self.keywords.in_dump(screen_dump, "next") and self.d(textMatches=self.keywords.pattern("next")).exists:
+            self.perform_popup_step("initial_popups", self.d(textMatches=self.keywords.pattern("next")))
+            if self.d(textMatches=self.keywords.pattern("ok")).exists:
+                self.perform_popup_step("initial_popups", self.d(textMatches=self.keywords.pattern("ok")))
             screen_dump = self.d.dump()
         if self.verbose:
             print("Handled general app initial prompts")
             self.dump_screen_information("handled_app_initial_prompts", dump=screen_dump)
-        if not re.search('text=".*(?i)\\b(ok).*"', screen_dump) and not re.search('text=".*(?i)\\b(next).*"', screen_dump):
+        if not self.keywords.in_dump(screen_dump, "ok", "next"):
             self.cloudwatch_metrics["Passed_initial_popups"] = 1
             if self.verbose:
                 print("Handled camera prompts just fine")
@@ -394,22 +775,22 @@ class OneTimePopupHandler:
         if ((screen_dump.find('class="android.widget.CheckBox"') != -1) and
             self.d(className="android.widget.CheckBox").checked):
             self.perform_popup_step("initial_chrome_prompts", self.d(className="android.widget.CheckBox"))
-        if re.search('text=".*(?i)\\b(undo).*"', screen_dump) and self.d(textMatches=".*(?i)\\b(undo).*").exists:
-            self.perform_popup_step("initial_chrome_prompts", self.d(textMatches=".*(?i)\\b(undo).*"))
+        if self.keywords.in_dump(screen_dump, "undo") and self.d(textMatches=self.keywords.pattern("undo")).exists:
+            self.perform_popup_step("initial_chrome_prompts", self.d(textMatches=self.keywords.pattern("undo")))
             screen_dump = self.d.dump()
-        if re.search('text=".*(?i)\\b(accept).*"', screen_dump) and self.d(textMatches=".*(?i)\\b(accept).*").exists:
-            self.perform_popup_step("initial_chrome_prompts", self.d(textMatches=".*(?i)\\b(accept).*"))
+        if self.keywords.in_dump(screen_dump, "accept") and self.d(textMatches=self.keywords.pattern("accept")).exists:
+            self.perform_popup_step("initial_chrome_prompts", self.d(textMatches=self.keywords.pattern("accept")))
             sleep(3)
             screen_dump = self.d.dump()
-        if re.search('text=".*(?i)\\b(no)\\b.*"', screen_dump) and self.d(textMatches=".*(?i)\\b(no)\\b.*").exists:
-            self.perform_popup_step("initial_chrome_prompts", self.d(textMatches=".*(?i)\\b(no)\\b.*"))
+        if self.keywords.in_dump(screen_dump, "no") and self.d(textMatches=self.keywords.pattern("no")).exists:
+            self.perform_popup_step("initial_chrome_prompts", self.d(textMatches=self.keywords.pattern("no")))
             screen_dump = self.d.dump()
-        if re.search('text=".*(?i)\\b(continue).*"', screen_dump) and self.d(textMatches=".*(?i)\\b(continue).*").exists:
-            self.perform_popup_step("initial_chrome_prompts", self.d(textMatches=".*(?i)\\b(continue).*"))
+        if self.keywords.in_dump(screen_dump, "continue") and self.d(textMatches=self.keywords.pattern("continue")).exists:
+            self.perform_popup_step("initial_chrome_prompts", self.d(textMatches=self.keywords.pattern("continue")))
             sleep(1)
             screen_dump = self.d.dump()
-        if re.search('text=".*(?i)\\b(no)\\b.*"', screen_dump) and self.d(textMatches=".*(?i)\\b(no)\\b.*").exists:
-            self.perform_popup_step("initial_chrome_prompts", self.d(textMatches=".*(?i)\\b(no)\\b.*"))
+        if self.keywords.in_dump(screen_dump, "no") and self.d(textMatches=self.keywords.pattern("no")).exists:
+            self.perform_popup_step("initial_chrome_prompts", self.d(textMatches=self.keywords.pattern("no")))
             screen_dump = self.d.dump()
         if self.verbose:
             print("Handled Chrome initial prompts")
@@ -458,20 +839,20 @@ class OneTimePopupHandler:
         """
         Handles the popups explaining how the keyboard works via some helpful "tips"
         """
-        if self.d(className="android.widget.CheckBox", textContains="Do not").exists:
+        if self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")).exists:
             if self.verbose:
                 print("Handling keyboard tips popup dialog")
                 self.dump_screen_information("handling_keyboard_tips")
-            if (self.d(className="android.widget.CheckBox", textContains="Do not").exists and not
-                self.d(className="android.widget.CheckBox", textContains="Do not").checked):
-                self.perform_popup_step("text_popups", self.d(className="android.widget.CheckBox", textContains="Do not"))
-            if self.d(className="android.widget.Button", textContains="Next").exists:
-                self.perform_popup_step("text_popups", self.d(className="android.widget.Button", textContains="Next"))
-            if (self.d(className="android.widget.CheckBox", textContains="Do not").exists and not
-                self.d(className="android.widget.CheckBox", textContains="Do not").checked):
-                self.perform_popup_step("text_popups", self.d(className="android.widget.CheckBox", textContains="Do not"))
-            if self.d(className="android.widget.Button", textContains="Dismiss").exists:
-                self.perform_popup_step("text_popups", self.d(className="android.widget.Button", textContains="Dismiss"))
+            if (self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")).exists and not
+                self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")).checked):
+                self.perform_popup_step("text_popups", self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")))
+            if self.d(className="android.widget.Button", textMatches=self.keywords.pattern("next")).exists:
+                self.perform_popup_step("text_popups", self.d(className="android.widget.Button", textMatches=self.keywords.pattern("next")))
+            if (self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")).exists and not
+                self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")).checked):
+                self.perform_popup_step("text_popups", self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")))
+            if self.d(className="android.widget.Button", textMatches=self.keywords.pattern("dismiss")).exists:
+                self.perform_popup_step("text_popups", self.d(className="android.widget.Button", textMatches=self.keywords.pattern("dismiss")))
             if self.verbose:
                 print("Handled keyboard tips popup dialog")
                 self.dump_screen_information("handled_keyboard_tips")
@@ -481,51 +862,61 @@ class OneTimePopupHandler:
         Goes to the keyboard settings and disables any predictive text analytics stuff
         Uses screen dumps as an optimization in some cases instead of selector calls
         """
-        if self.d(text="Settings").exists:
-            self.perform_popup_step("text_popups", self.d(text="Settings"))
+        if self.d(textMatches=self.keywords.pattern("settings")).exists:
+            self.perform_popup_step("text_popups", self.d(textMatches=self.keywords.pattern("settings")))
             screen_dump = self.d.dump()
             if self.verbose:
                 print("Disabling keyboard predictive settings")
                 self.dump_screen_information("handling_predictive_settings", dump=screen_dump)
             i = 0
-            while i < 10 and not (re.search('text=".*(?i)\\b(Personalized).*"', screen_dump) or
-                re.search('text=".*(?i)\\b(personal language).*"', screen_dump) or
-                re.search('text=".*(?i)\\b(Predictive).*"', screen_dump)):
+            while i < 10 and not self.keywords.in_dump(screen_dump,
+                "personalized", "personal_language", "predictive"):
                 sleep(1)
                 i+=1
                 screen_dump = self.d.dump()
-            if (re.search('text=".*(?i)\\b(Personalized).*"', screen_dump) and 
-                self.d(textContains="Personalized",).exists and
-                self.d(textContains="Personalized",).right(className="android.widget.CheckBox") and
-                self.d(textContains="Personalized",).right(className="android.widget.CheckBox").checked):
-                self.perform_popup_step("text_popups",
-                    self.d(textContains="Personalized",).right(className="android.widget.CheckBox"))
-            if (re.search('text=".*(?i)\\b(personal language).*"', screen_dump) and 
-                self.d(textContains="personal language",).exists and 
-                self.d(textContains="personal language",).right(className="android.widget.CheckBox") and
-                self.d(textContains="personal language",).right(className="android.widget.CheckBox").checked):
-                self.perform_popup_step("text_popups",
-                    self.d(textContains="personal language",).right(className="android.widget.CheckBox"))
-            if (re.search('text=".*(?i)\\b(Personalized).*"', screen_dump) and
-                self.d(textContains="Personalized",className="android.widget.CheckBox").exists and
-                self.d(textContains="Personalized",className="android.widget.CheckBox").checked):
-                self.perform_popup_step("text_popups", 
-                    self.d(textContains="Personalized",className="android.widget.CheckBox"))
-            if (re.search('text=".*(?i)\\b(Predictive).*"', screen_dump) and
-                self.d(textContains="Predictive", resourceId="android:id/action_bar_title").exists and 
-                self.d(textContains="Predictive", resourceId="android:id/action_bar_title").right(
-                    className="android.widget.Switch") and
-                self.d(textContains="Predictive", resourceId="android:id/action_bar_title").right(
-                    className="android.widget.Switch").checked):
-                self.perform_popup_step("text_popups", 
-                    self.d(textContains="Predictive", resourceId="android:id/action_bar_title").right(
-                        className="android.widget.Switch"))
+            # Look up every settings row and toggle in one round trip rather than a dozen separate
+            # exists/right/checked calls
+            query = BatchedSelectorQuery(self.d)
+            personalized = query.info(textMatches=self.keywords.pattern("personalized"))
+            personal_language = query.info(textMatches=self.keywords.pattern("personal_language"))
+            personalized_checkbox = query.info(textMatches=self.keywords.pattern("personalized"), className="android.widget.CheckBox")
+            predictive = query.info(textMatches=self.keywords.pattern("predictive"), resourceId="android:id/action_bar_title")
+            checkboxes = query.info_of_all_instances(className="android.widget.CheckBox")
+            switches = query.info_of_all_instances(className="android.widget.Switch")
+            results = query.execute()
+            # checked values all come from the one snapshot, so make sure no toggle is clicked twice,
+            # and once something was clicked make sure the next target is still there before clicking it
+            toggled = set()
+            def toggle_off(info):
+                if not info or not info["checked"]:
+                    return
+                bounds = tuple(sorted(info["bounds"].items()))
+                if bounds in toggled:
+                    return
+                if toggled:
+                    recheck = BatchedSelectorQuery(self.d)
+                    current = recheck.info_of_all_instances(className=info["className"])
+                    info = next((view for view in recheck.execute()[current] or []
+                        if tuple(sorted(view["bounds"].items())) == bounds), None)
+                    if not info or not info["checked"]:
+                        if self.verbose:
+                            print("Screen changed since the settings snapshot, not clicking %s"%(bounds,))
+                        return
+                toggled.add(bounds)
+                self.perform_popup_step_from_info("text_popups", info)
+            for concept, label, candidates in [
+                ("personalized", personalized, checkboxes),
+                ("personal_language", personal_language, checkboxes),
+                ("predictive", predictive, switches)]:
+                if not self.keywords.in_dump(screen_dump, concept):
+                    continue
+                toggle_off(BatchedSelectorQuery.right_of(results[label], results[candidates]))
+                if concept == "personalized":
+                    toggle_off(results[personalized_checkbox])
             if self.verbose:
                 print("Disabled keyboard predictive settings")
                 self.dump_screen_information("handled_predictive_settings", dump=screen_dump)
-            if (re.search('text=".*(?i)\\b(Personalized).*"', screen_dump) or
-                re.search('text=".*(?i)\\b(personal language).*"', screen_dump) or
-                re.search('text=".*(?i)\\b(Predictive).*"', screen_dump)):
+            if self.keywords.in_dump(screen_dump, "personalized", "personal_language", "predictive"):
                 self.popup_handling_steps["text_popups"].append({"press": "back"})
                 self.d.press.back()
                 sleep(2)
@@ -548,36 +939,36 @@ class OneTimePopupHandler:
             self.check_for_keyboard_tips()
             self.handle_keyboard_settings()
             self.check_for_keyboard_tips()
-            if self.d(text="No, thanks").exists:
-                self.perform_popup_step("text_popups", self.d(text="No, thanks"))
-            if self.d(text="No").exists:
-                self.perform_popup_step("text_popups", self.d(text="No"))
-            if self.d(text="OK").exists:
-                self.perform_popup_step("text_popups", self.d(text="OK"))
+            if self.d(textMatches=self.keywords.pattern("no_thanks")).exists:
+                self.perform_popup_step("text_popups", self.d(textMatches=self.keywords.pattern("no_thanks")))
+            if self.d(textMatches=self.keywords.pattern("no_button")).exists:
+                self.perform_popup_step("text_popups", self.d(textMatches=self.keywords.pattern("no_button")))
+            if self.d(textMatches=self.keywords.pattern("ok_button")).exists:
+                self.perform_popup_step("text_popups", self.d(textMatches=self.keywords.pattern("ok_button")))
                 sleep(2)
                 if self.d(className="android.widget.EditText").exists:
                     self.perform_popup_step("text_popups", self.d(className="android.widget.EditText"))
-            if (self.d(className="android.widget.CheckBox", textContains="Do not").exists and not
-                self.d(className="android.widget.CheckBox", textContains="Do not").checked):
+            if (self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")).exists and not
+                self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")).checked):
                 self.perform_popup_step("text_popups", 
-                    self.d(className="android.widget.CheckBox", textContains="Do not"))
-                if self.d(text="OK").exists:
-                    self.perform_popup_step("text_popups", self.d(text="OK"))
-            if (self.d(className="android.widget.CheckBox", textContains="Turn on personalized").exists and
-                self.d(className="android.widget.CheckBox", textContains="Turn on personalized").checked):
+                    self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("do_not")))
+                if self.d(textMatches=self.keywords.pattern("ok_button")).exists:
+                    self.perform_popup_step("text_popups", self.d(textMatches=self.keywords.pattern("ok_button")))
+            if (self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("turn_on_personalized")).exists and
+                self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("turn_on_personalized")).checked):
                 self.perform_popup_step("text_popups", 
-                    self.d(className="android.widget.CheckBox", textContains="Turn on personalized"))
-            elif (self.d(className="android.widget.CheckBox", textContains="personalized").exists and not
-                self.d(className="android.widget.CheckBox", textContains="personalized").checked):
+                    self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("turn_on_personalized")))
+            elif (self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("personalized")).exists and not
+                self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("personalized")).checked):
                 self.perform_popup_step("text_popups", 
-                    self.d(className="android.widget.CheckBox", textContains="personalized"))
-            if self.d(text="OK").exists:
-                self.perform_popup_step("text_popups", self.d(text="OK"))
-            if self.d(text="A picture is worth 1000 words").exists:
-                self.perform_popup_step("text_popups", self.d(text="NEXT"))
+                    self.d(className="android.widget.CheckBox", textMatches=self.keywords.pattern("personalized")))
+            if self.d(textMatches=self.keywords.pattern("ok_button")).exists:
+                self.perform_popup_step("text_popups", self.d(textMatches=self.keywords.pattern("ok_button")))
+            if self.d(textMatches=self.keywords.pattern("gif_keyboard_intro")).exists:
+                self.perform_popup_step("text_popups", self.d(textMatches=self.keywords.pattern("next_button")))
                 sleep(2)
-            if self.d(text="START").exists:
-                self.perform_popup_step("text_popups", self.d(text="START"))
+            if self.d(textMatches=self.keywords.pattern("start_button")).exists:
+                self.perform_popup_step("text_popups", self.d(textMatches=self.keywords.pattern("start_button")))
                 sleep(2)
             self.handle_keyboard_settings()
             if retry and self.verbose:
@@ -635,6 +1026,97 @@ class OneTimePopupHandler:
         self.d(className="android.widget.EditText").clear_text()
         return True
 
+    def finish_device_preparation(self, timeout):
+        """
+        Waits for the background device preparation started by popup_walkthrough, if any, and
+        reports its error instead of leaving it on the thread
+        """
+        task, self.device_preparation = self.device_preparation, None
+        if task is None:
+            return
+        try:
+            task.wait(timeout)
+        except Exception as e:
+            print("Device preparation failed:", type(e), e)
+
+    def prepare_device(self):
+        """
+        Clears the data of every installed keyboard in KEYBOARD_PACKAGES so their one-time popups
+        are shown again. Lists the installed packages once and clears them in a single adb shell command.
+        """
+        try:
+            package_list = check_output(["adb", "shell", "pm", "list", "packages"]).decode("utf-8", "ignore")
+            installed = set(line.strip()[len("package:"):] for line in package_list.splitlines()
+                if line.strip().startswith("package:"))
+            if self.verbose:
+                print("=================LISTING PACKAGES======================")
+                print(package_list)
+            packages = [package for package in KEYBOARD_PACKAGES if package in installed]
+        except Exception as e:
+            print("Could not list packages, clearing every known keyboard:", type(e), e)
+            packages = KEYBOARD_PACKAGES
+        if not packages:
+            return []
+        if self.verbose:
+            print("Clearing out keyboards: %s"%", ".join(packages))
+        call(["adb", "shell", "; ".join("pm clear %s"%package for package in packages)])
+        return packages
+
+    def device_model_and_build(self):
+        identifiers = []
+        for prop in ["ro.product.model", "ro.build.id"]:
+            try:
+                identifiers.append(check_output(["adb", "shell", "getprop", prop]).decode("utf-8", "ignore").strip())
+            except Exception:
+                identifiers.append("unknown")
+        return identifiers
+
+    def handle_chrome_initial_popups(self):
+        call(["adb", "shell", "am", "start", "-n",
+            "com.android.chrome/com.google.android.apps.chrome.Main"])
+        sleep(1)
+        return self.handle_initial_popups()
+
+    def handle_textbox_popups(self):
+        # the keyboards must be cleared before their popups can show up
+        self.device_preparation.wait()
+        success = self.handle_text_popups()
+        self.d.press.back()
+        self.d.press.back()
+        self.d.press.back()
+        return success
+
+    def run_stage(self, stage):
+        """
+        Runs one walkthrough stage with the attempts and fast path the planner allocates it,
+        and records its outcome for future plans. Only retriable_stages get more than one attempt.
+        """
+        steps_key = "text_popups" if stage == "textbox_popups" else stage
+        fast_path = self.planner.is_usually_empty(stage)
+        stage_methods = {
+            "initial_popups": self.handle_chrome_initial_popups,
+            "initial_chrome_prompts": self.handle_initial_chrome_prompts,
+            "textbox_popups": self.handle_textbox_popups,
+            "camera_prompts": lambda: self.trigger_and_handle_camera_popups(fast_path=fast_path),
+            "app_switcher_popups": lambda: self.trigger_and_handle_app_switch_popup(fast_path=fast_path),
+        }
+        steps_before = len(self.popup_handling_steps.get(steps_key, []))
+        start = time()
+        max_attempts = self.planner.attempts(stage) if stage in self.retriable_stages else 1
+        attempts = 0
+        success = False
+        try:
+            while attempts < max_attempts and not success:
+                attempts += 1
+                success = stage_methods[stage]()
+            if success:
+                self.cloudwatch_metrics.pop("Failed_"+stage, None)
+        finally:
+            # stages that raise or time out are recorded as failures too
+            self.planner.record(stage, success, time()-start,
+                len(self.popup_handling_steps.get(steps_key, [])) - steps_before, attempts)
+        return success
+
     @timeout(TIMEOUT_DURATION)
     def perform_popup_walkthrough(self):
         success = False
@@ -676,57 +1158,23 @@ class OneTimePopupHandler:
                     self.start_time+" - "+generic_cloudwatch_log_prefix
                     +"Failed to initialize test due to sporadic popups like system updates")
                 return False
-            try:
-                if self.verbose:
-                    print("=================LISTING PACKAGES======================")
-                    print(str(check_output(["adb", "shell", "cmd", "package", "list", "packages"]).encode("utf-8")))
-                    sleep(2)
-            except Exception as e:
-                    print("Could not list packages. Moving on.")
-
-            #clear all other keyboards
-            if self.verbose:
-                print("Clearing out latin keyboard:")
-
-            call(["adb", "shell", "pm", "clear", "com.google.android.inputmethod.latin"])
-            sleep(2)
+            # Clearing keyboards only matters once we reach the text box, so let it run alongside
+            # whichever stages come before it
+            self.device_preparation = BackgroundTask.start_new("device_preparation", self.prepare_device)
 
-            #Clear hindi keyboard
-            if self.verbose:
-                print("Clearing out hindi keyboard:")
-
-            call(["adb", "shell", "pm", "clear", "com.google.android.apps.inputmethod.hindi"])
-            sleep(2)
-
-            # Clear samsung keyboard
-            if self.verbose:
-                print("Clearing out samsung keyboard:")
-
-            call(["adb", "shell", "pm", "clear", "com.sec.android.inputmethod"])
-            sleep(2)
-
-            call(["adb", "shell", "am", "start", "-n",
-                "com.android.chrome/com.google.android.apps.chrome.Main"])
-            sleep(1)
-
-            success = self.handle_initial_popups()
-
-            #these depend on the previous step
-            if success:
-                success = self.handle_initial_chrome_prompts()
-
-            #these depend on the previous step
-            if success:
-                success = self.handle_text_popups()
-                self.d.press.back()
-                self.d.press.back()
-                self.d.press.back()
-
-            success = success and self.trigger_and_handle_camera_popups()
-            
-            success = success and self.trigger_and_handle_app_switch_popup()
-
-            return success
+            if self.planner is None:
+                self.planner = StagePlanner(self.history_file, *self.device_model_and_build())
+            # Stages within a group depend on the previous one; the groups themselves are independent
+            stage_groups = self.planner.order([
+                ["initial_popups", "initial_chrome_prompts", "textbox_popups"],
+                ["camera_prompts"],
+                ["app_switcher_popups"],
+            ])
+            for group in stage_groups:
+                for stage in group:
+                    if not self.run_stage(stage):
+                        return False
+            return True
 
         except Exception as e:
             try:
@@ -748,6 +1196,9 @@ class OneTimePopupHandler:
                     self.start_time+" - "+generic_cloudwatch_log_prefix
                     +"Failed due to a timeout.")
                 raise e
+        finally:
+            # don't leave pm clear running into the next attempt or the teardown
+            self.finish_device_preparation(self.device_preparation_timeout)
 
         return False
 
@@ -759,18 +1210,17 @@ if __name__ == "__main__":
     success = False
     duration = -1
     try:
-        popup_handler_class = OneTimePopupHandler()
-        popup_handler_class.parse_arguments()
-        TIMEOUT_DURATION = popup_handler_class.timeout_duration
-        try:
-            success = popup_handler_class.perform_popup_walkthrough()
-        except TimeoutError:
-            print("Timed out while trying to walk through popups")
-            success = False
-            popup_handler_class.dump_screen_information("timed_out_at_this_point")
-        duration = time()-start_time
-        popup_handler_class.cloudwatch_metrics["Duration"] = duration
-        popup_handler_class = None
+        with OneTimePopupHandler() as popup_handler_class:
+            popup_handler_class.parse_arguments()
+            TIMEOUT_DURATION = popup_handler_class.timeout_duration
+            try:
+                success = popup_handler_class.perform_popup_walkthrough()
+            except TimeoutError:
+                print("Timed out while trying to walk through popups")
+                success = False
+                popup_handler_class.dump_screen_information("timed_out_at_this_point")
+            duration = time()-start_time
+            popup_handler_class.cloudwatch_metrics["Duration"] = duration
     except Exception as e:
         print(type(e), e, e.message if "message" in e.__dict__ else "")
     print("Took %s to %s complete the popup dismissal walkthrough"%
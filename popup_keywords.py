@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+Per-locale keyword tables for the popup handler.
+
+Each concept (a button or message the handler looks for) has English keywords plus translations
+for the languages below. KeywordMatcher compiles English and the device language once per session
+into selector patterns for uiautomator and a single regex that finds every concept in a screendump.
+Keywords are regex fragments. Concepts a locale doesn't translate fall back to English only.
+Chinese and Japanese get no word boundaries, so single-character keywords there (e.g. 不, 否) are
+only listed under exact concepts, where they can't match inside longer text.
+"""
+from __future__ import unicode_literals
+from subprocess import check_output
+from xml.sax.saxutils import unescape
+import re
+
+# How a concept's keywords have to line up with the text of a view:
+#   "word": whole words anywhere in the text
+#   "exact": the whole text
+# A word keyword ending in \\w* matches words starting with it instead (so "ok\\w*" also matches
+# "Okay"). Translations only use that for stems, since short words like "ок" or "fine" are also the
+# start of unrelated ones ("Окно", "Finestra").
+CONCEPT_MATCHING = {
+    "ok": "word",
+    "next": "word",
+    "done": "word",
+    "close": "word",
+    "clear": "word",
+    "undo": "word",
+    "accept": "word",
+    "no": "word",
+    "continue": "word",
+    "do_not": "word",
+    "dismiss": "word",
+    "settings": "exact",
+    "no_thanks": "exact",
+    "no_button": "exact",
+    "ok_button": "exact",
+    "next_button": "exact",
+    "start_button": "exact",
+    "personalized": "word",
+    "turn_on_personalized": "word",
+    "personal_language": "word",
+    "predictive": "word",
+    "gif_keyboard_intro": "exact",
+    "sim": "word",
+    "unfortunately": "word",
+    "not_responding": "word",
+    "system_popup": "word",
+    "negatory": "word",
+    "affirmatory": "word",
+    "autostart": "word",
+    "software_update": "word",
+    "do_not_show_again": "exact",
+}
+
+KEYWORDS = {
+    "en": {
+        "ok": ["ok\\w*"],
+        "next": ["next"],
+        "done": ["done"],
+        "close": ["close"],
+        "clear": ["clear"],
+        "undo": ["undo"],
+        "accept": ["accept"],
+        "no": ["no"],
+        "continue": ["continue"],
+        "do_not": ["do not"],
+        "dismiss": ["dismiss"],
+        "settings": ["settings"],
+        "no_thanks": ["no, thanks"],
+        "no_button": ["no"],
+        "ok_button": ["ok"],
+        "next_button": ["next"],
+        "start_button": ["start"],
+        "personalized": ["personalized"],
+        "turn_on_personalized": ["turn on personalized"],
+        "personal_language": ["personal language"],
+        "predictive": ["predictive"],
+        "gif_keyboard_intro": ["a picture is worth 1000 words"],
+        "sim": ["sim", "mobile data"],
+        "unfortunately": ["unfortunately"],
+        "not_responding": ["responding"],
+        "system_popup": ["attention", "hands free activation", "multi window", "select home", "update firmware"],
+        "negatory": ["cancel", "later", "no", "deny", "decline", "skip", "close app", "don't send", "block",
+            "just once"],
+        "affirmatory": ["ok", "okay", "yes", "start", "accept", "allow"],
+        "autostart": ["autostart"],
+        "software_update": ["install overnight", "download", "yes, i'm in", "install", "install now",
+            "software update", "software upgrade", "system upgrade", "system update", "system software"],
+        "do_not_show_again": ["(do not|don't) show again"],
+    },
+    "es": {
+        # only a bare "Aceptar", so Chrome's "Aceptar y continuar" terms button stays under accept
+        "ok": ["^aceptar$"],
+        "next": ["siguiente"],
+        "done": ["listo", "hecho"],
+        "close": ["cerrar"],
+        "clear": ["borrar", "eliminar"],
+        "undo": ["deshacer"],
+        "accept": ["aceptar", "acepto"],
+        "no": ["no"],
+        "continue": ["continuar"],
+        "do_not": ["no volver", "no mostrar"],
+        "dismiss": ["descartar", "ignorar"],
+        "settings": ["ajustes", "configuración"],
+        "no_thanks": ["no, gracias"],
+        "no_button": ["no"],
+        "ok_button": ["aceptar"],
+        "next_button": ["siguiente"],
+        "start_button": ["iniciar", "empezar", "comenzar"],
+        "personalized": ["personalizad\\w*"],
+        "predictive": ["predictiv\\w*"],
+        "sim": ["sim", "datos móviles"],
+        "unfortunately": ["lamentablemente", "desafortunadamente"],
+        "not_responding": ["no responde"],
+        "negatory": ["cancelar", "más tarde", "no", "denegar", "rechazar", "omitir", "bloquear", "solo una vez"],
+        "affirmatory": ["aceptar", "sí", "iniciar", "permitir"],
+        "software_update": ["descargar", "instalar", "instalar ahora", "actualización de software",
+            "actualización del sistema"],
+        "do_not_show_again": ["no (volver a mostrar|mostrar de nuevo|mostrar otra vez)"],
+    },
+    "pt": {
+        "ok": ["ok"],
+        "next": ["próximo", "avançar", "seguinte"],
+        "done": ["concluído", "concluir"],
+        "close": ["fechar"],
+        "clear": ["limpar"],
+        "undo": ["desfazer"],
+        "accept": ["aceitar", "aceito"],
+        "no": ["não"],
+        "continue": ["continuar"],
+        "do_not": ["não mostrar", "não exibir"],
+        "dismiss": ["dispensar", "ignorar"],
+        "settings": ["configurações", "definições"],
+        "no_thanks": ["não, obrigado"],
+        "no_button": ["não"],
+        "next_button": ["próximo", "avançar", "seguinte"],
+        "start_button": ["iniciar", "começar"],
+        "personalized": ["personalizad\\w*"],
+        "predictive": ["preditiv\\w*", "previsão"],
+        "sim": ["sim card", "cartão sim", "dados móveis"],
+        "unfortunately": ["infelizmente"],
+        "not_responding": ["não está respondendo", "não responde"],
+        "negatory": ["cancelar", "mais tarde", "não", "negar", "recusar", "ignorar", "pular", "bloquear",
+            "apenas uma vez"],
+        "affirmatory": ["ok", "sim", "iniciar", "aceitar", "permitir"],
+        "software_update": ["transferir", "baixar", "instalar", "instalar agora", "atualização de software",
+            "atualização do sistema"],
+        "do_not_show_again": ["não (mostrar|exibir) novamente"],
+    },
+    "fr": {
+        "ok": ["ok"],
+        "next": ["suivant"],
+        "done": ["terminé", "ok"],
+        "close": ["fermer"],
+        "clear": ["effacer", "tout fermer"],
+        "undo": ["annuler"],
+        "accept": ["accepter", "j'accepte"],
+        "no": ["non"],
+        "continue": ["continuer"],
+        "do_not": ["ne plus", "ne pas"],
+        "dismiss": ["ignorer", "fermer"],
+        "settings": ["paramètres"],
+        "no_thanks": ["non, merci"],
+        "no_button": ["non"],
+        "next_button": ["suivant"],
+        "start_button": ["démarrer", "commencer"],
+        "personalized": ["personnalis\\w*"],
+        "predictive": ["prédicti\\w*", "saisie intuitive"],
+        "sim": ["sim", "données mobiles"],
+        "unfortunately": ["malheureusement"],
+        "not_responding": ["ne répond pas"],
+        "negatory": ["annuler", "plus tard", "non", "refuser", "ignorer", "passer", "bloquer", "une seule fois"],
+        "affirmatory": ["ok", "oui", "démarrer", "accepter", "autoriser"],
+        "software_update": ["télécharger", "installer", "installer maintenant", "mise à jour logicielle",
+            "mise à jour du système"],
+        "do_not_show_again": ["ne plus (afficher|montrer)"],
+    },
+    "de": {
+        "ok": ["ok"],
+        "next": ["weiter"],
+        "done": ["fertig"],
+        "close": ["schließen"],
+        "clear": ["löschen", "alle schließen"],
+        "undo": ["rückgängig"],
+        "accept": ["akzeptieren", "zustimmen"],
+        "no": ["nein"],
+        "continue": ["weiter", "fortfahren"],
+        "do_not": ["nicht mehr", "nicht erneut"],
+        "dismiss": ["schließen", "verwerfen"],
+        "settings": ["einstellungen"],
+        "no_thanks": ["nein, danke"],
+        "no_button": ["nein"],
+        "next_button": ["weiter"],
+        "start_button": ["starten"],
+        "personalized": ["personalisiert\\w*"],
+        "predictive": ["texterkennung", "wortvorschläge", "vorhersage\\w*"],
+        "sim": ["sim", "mobile daten"],
+        "unfortunately": ["leider"],
+        "not_responding": ["reagiert nicht"],
+        "negatory": ["abbrechen", "später", "nein", "ablehnen", "überspringen", "blockieren", "nur einmal"],
+        "affirmatory": ["ok", "ja", "starten", "akzeptieren", "zulassen"],
+        "software_update": ["herunterladen", "installieren", "jetzt installieren", "software-update",
+            "systemaktualisierung", "systemupdate"],
+        "do_not_show_again": ["nicht (mehr|erneut|wieder) anzeigen"],
+    },
+    "it": {
+        "ok": ["ok"],
+        "next": ["avanti", "successivo"],
+        "done": ["fine", "fatto"],
+        "close": ["chiudi"],
+        "clear": ["cancella", "chiudi tutto"],
+        "undo": ["annulla"],
+        "accept": ["accetta", "accetto"],
+        "no": ["no"],
+        "continue": ["continua"],
+        "do_not": ["non mostrare", "non visualizzare"],
+        "dismiss": ["ignora", "chiudi"],
+        "settings": ["impostazioni"],
+        "no_thanks": ["no, grazie"],
+        "no_button": ["no"],
+        "next_button": ["avanti", "successivo"],
+        "start_button": ["avvia", "inizia"],
+        "personalized": ["personalizzat\\w*"],
+        "predictive": ["predittiv\\w*", "intuitivo"],
+        "sim": ["sim", "dati mobili"],
+        "unfortunately": ["purtroppo"],
+        "not_responding": ["non risponde"],
+        "negatory": ["annulla", "più tardi", "no", "nega", "rifiuta", "salta", "blocca", "solo una volta"],
+        "affirmatory": ["ok", "sì", "avvia", "accetta", "consenti"],
+        "software_update": ["scarica", "installa", "installa ora", "aggiornamento software",
+            "aggiornamento di sistema"],
+        "do_not_show_again": ["non (mostrare|visualizzare) (più|di nuovo)"],
+    },
+    "ru": {
+        "ok": ["ок", "ok"],
+        "next": ["далее"],
+        "done": ["готово"],
+        "close": ["закрыть"],
+        "clear": ["очистить", "закрыть все"],
+        "undo": ["отменить"],
+        "accept": ["принять", "принимаю"],
+        "no": ["нет"],
+        "continue": ["продолжить"],
+        "do_not": ["больше не", "не показывать"],
+        "dismiss": ["закрыть", "скрыть"],
+        "settings": ["настройки"],
+        "no_thanks": ["нет, спасибо"],
+        "no_button": ["нет"],
+        "ok_button": ["ок", "ok"],
+        "next_button": ["далее"],
+        "start_button": ["начать", "запустить"],
+        "personalized": ["персонализ\\w*"],
+        "predictive": ["предикативн\\w*", "подсказ\\w*"],
+        "sim": ["sim", "мобильные данные", "мобильный интернет"],
+        "unfortunately": ["к сожалению"],
+        "not_responding": ["не отвечает"],
+        "negatory": ["отмена", "позже", "нет", "запретить", "отклонить", "пропустить", "блокировать",
+            "только сейчас"],
+        "affirmatory": ["ок", "ok", "да", "начать", "принять", "разрешить"],
+        "software_update": ["загрузить", "установить", "установить сейчас", "обновление по",
+            "обновление системы"],
+        "do_not_show_again": ["больше не показывать"],
+    },
+    "ja": {
+        "ok": ["ok"],
+        "next": ["次へ"],
+        "done": ["完了"],
+        "close": ["閉じる"],
+        "clear": ["すべて消去", "消去"],
+        "undo": ["元に戻す"],
+        "accept": ["同意", "承諾"],
+        "no": ["いいえ"],
+        "continue": ["続行"],
+        "do_not": ["今後表示しない", "表示しない"],
+        "dismiss": ["閉じる"],
+        "settings": ["設定"],
+        "no_thanks": ["今はしない"],
+        "no_button": ["いいえ"],
+        "next_button": ["次へ"],
+        "start_button": ["開始"],
+        "personalized": ["パーソナライズ"],
+        "predictive": ["予測"],
+        "sim": ["sim", "モバイルデータ"],
+        "unfortunately": ["問題が発生"],
+        "not_responding": ["応答していません"],
+        "negatory": ["キャンセル", "後で", "いいえ", "拒否", "スキップ", "ブロック", "1回のみ"],
+        "affirmatory": ["ok", "はい", "開始", "同意", "許可"],
+        "software_update": ["ダウンロード", "インストール", "今すぐインストール", "ソフトウェア更新",
+            "システムアップデート"],
+        "do_not_show_again": ["今後(は)?表示しない"],
+    },
+    "ko": {
+        "ok": ["확인"],
+        "next": ["다음"],
+        "done": ["완료"],
+        "close": ["닫기"],
+        "clear": ["모두 닫기", "지우기"],
+        "undo": ["실행 취소"],
+        "accept": ["동의\\w*"],
+        "no": ["아니요"],
+        "continue": ["계속"],
+        "do_not": ["다시 표시 안 함", "다시 보지 않기"],
+        "dismiss": ["닫기"],
+        "settings": ["설정"],
+        "no_thanks": ["괜찮습니다"],
+        "no_button": ["아니요"],
+        "ok_button": ["확인"],
+        "next_button": ["다음"],
+        "start_button": ["시작"],
+        "personalized": ["맞춤\\w*"],
+        "predictive": ["예측"],
+        "sim": ["sim", "모바일 데이터"],
+        "unfortunately": ["중지되었습니다"],
+        "not_responding": ["응답하지 않습니다"],
+        "negatory": ["취소", "나중에", "아니요", "거부", "건너뛰기", "차단", "한 번만"],
+        "affirmatory": ["확인", "예", "시작", "동의", "허용"],
+        "software_update": ["다운로드", "설치", "지금 설치", "소프트웨어 업데이트", "시스템 업데이트"],
+        "do_not_show_again": ["다시 (표시 안 함|보지 않기)"],
+    },
+    "zh": {
+        "ok": ["确定", "確定"],
+        "next": ["下一步"],
+        "done": ["完成"],
+        "close": ["关闭", "關閉"],
+        "clear": ["全部清除", "清除"],
+        "undo": ["撤消", "復原"],
+        "accept": ["接受", "同意"],
+        "continue": ["继续", "繼續"],
+        "do_not": ["不再显示", "不再顯示"],
+        "dismiss": ["关闭", "關閉"],
+        "settings": ["设置", "設定"],
+        "no_thanks": ["不用了", "不，谢谢", "不，謝謝"],
+        "no_button": ["否", "不"],
+        "ok_button": ["确定", "確定", "好"],
+        "next_button": ["下一步"],
+        "start_button": ["开始", "開始"],
+        "personalized": ["个性化", "個人化"],
+        "predictive": ["预测", "預測"],
+        "sim": ["sim", "移动数据", "行動數據"],
+        "unfortunately": ["已停止运行", "已停止運作"],
+        "not_responding": ["没有响应", "沒有回應"],
+        "negatory": ["取消", "稍后", "稍後", "拒绝", "拒絕", "跳过", "略過", "仅限这一次", "僅限這一次"],
+        "affirmatory": ["确定", "確定", "开始", "開始", "接受", "允许", "允許"],
+        "software_update": ["下载", "下載", "安装", "安裝", "立即安装", "软件更新", "軟體更新", "系统更新", "系統更新"],
+        "do_not_show_again": ["不再(显示|顯示|提示)"],
+    },
+}
+
+# English keywords a locale drops because they mean something else in that language,
+# e.g. "sim" is "yes" in Portuguese and would whitelist every yes/no dialog as a SIM popup
+EXCLUDED_ENGLISH_KEYWORDS = {
+    "pt": {"sim": ["sim"]},
+}
+
+LOCALE_PROPERTIES = ["persist.sys.locale", "ro.product.locale", "persist.sys.language", "ro.product.locale.language"]
+
+
+def detect_device_language():
+    """
+    Returns the two letter language code of the connected device, or "en" if it can't be read
+    """
+    for prop in LOCALE_PROPERTIES:
+        try:
+            locale = check_output(["adb", "shell", "getprop", prop]).decode("utf-8", "ignore").strip()
+        except Exception:
+            continue
+        if locale:
+            return re.split("[-_]", locale)[0].lower()
+    return "en"
+
+
+def _is_hangul(character):
+    return (0x1100 <= ord(character) <= 0x11FF or 0x3130 <= ord(character) <= 0x318F or
+        0xAC00 <= ord(character) <= 0xD7AF)
+
+
+def _bounded(keyword):
+    """
+    Word boundaries only make sense around scripts that separate words with spaces, which
+    includes Korean but not Chinese or Japanese
+    """
+    return "\\b" if keyword[:1].isalnum() and (ord(keyword[0]) < 0x2E80 or _is_hangul(keyword[0])) else ""
+
+
+class KeywordMatcher:
+    """
+    English plus one device language, compiled once per session. pattern() gives the textMatches
+    string for a uiautomator selector, and in_dump() checks a screendump for any of several concepts
+    with a single regex that finds every concept on the screen at once.
+    """
+
+    def __init__(self, language="en"):
+        self.language = language
+        languages = ["en"] if language == "en" or language not in KEYWORDS else ["en", language]
+        self.fragments = {}
+        for concept, matching in CONCEPT_MATCHING.items():
+            keywords = []
+            excluded = EXCLUDED_ENGLISH_KEYWORDS.get(language, {}).get(concept, [])
+            for table in languages:
+                keywords.extend(keyword for keyword in KEYWORDS[table].get(concept, [])
+                    if keyword not in keywords and not (table == "en" and keyword in excluded))
+            if matching == "exact":
+                self.fragments[concept] = "(%s)"%"|".join(keywords)
+            else:
+                self.fragments[concept] = "(%s)"%"|".join("%s%s%s"%(_bounded(keyword), keyword,
+                    _bounded(keyword[-1]) if matching == "word" else "") for keyword in keywords)
+        self.text_attribute = re.compile(u'text="([^"]*)"')
+        self.matcher = re.compile("".join("(?:(?=%s(?P<%s>%s)%s))?"%(
+            "" if CONCEPT_MATCHING[concept] == "exact" else ".*?", concept, fragment,
+            "$" if CONCEPT_MATCHING[concept] == "exact" else "")
+            for concept, fragment in sorted(self.fragments.items())), re.I | re.U | re.S)
+        self._last_dump = None
+        self._last_present = set()
+
+    @classmethod
+    def for_device(cls):
+        return cls(detect_device_language())
+
+    def pattern(self, concept):
+        """
+        The textMatches value that selects views showing this concept
+        """
+        if CONCEPT_MATCHING[concept] == "exact":
+            return "(?i)%s"%self.fragments[concept]
+        return ".*(?i)%s.*"%self.fragments[concept]
+
+    def present(self, screen_dump):
+        """
+        Returns the set of concepts shown in the text of any view in the screendump
+        """
+        if screen_dump is self._last_dump:
+            return self._last_present
+        present = set()
+        for text in self.text_attribute.findall(screen_dump):
+            match = self.matcher.match(unescape(text, {"&quot;": '"', "&apos;": "'"}))
+            present.update(concept for concept, value in match.groupdict().items() if value is not None)
+        self._last_dump, self._last_present = screen_dump, present
+        return present
+
+    def in_dump(self, screen_dump, *concepts):
+        present = self.present(screen_dump)
+        return any(concept in present for concept in concepts)
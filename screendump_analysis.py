@@ -0,0 +1,228 @@
+"""
+Offline analysis of the screendumps the popup handler captures when a stage fails or times out.
+
+Reads failed_to_*_screendump.txt and timed_out_at_this_point_screendump.txt files out of directory
+trees and .tar/.tar.gz/.zip bundles in parallel, turns the clickable text and resource ids of each
+screen into a binary feature matrix, clusters similar failure screens and reports candidate
+selectors for each cluster in the same format as popup_selectors in
+chrome_initialization_and_popup_detection.py.
+
+    python screendump_analysis.py fleet_logs/ 2017-06-01.tar.gz --output clusters.yml
+"""
+from multiprocessing import Pool, cpu_count
+from sys import argv
+import os
+import re
+import argparse
+import tarfile
+import zipfile
+import numpy
+import yaml
+
+DUMP_NAME_PATTERN = re.compile(r"(failed_to_.*|failed_due_to_.*|timed_out_at_this_point)_screendump\.txt$")
+
+NODE_PATTERN = re.compile(r"<node\b([^>]*)>")
+
+ATTRIBUTE_PATTERN = re.compile(r'([\w-]+)="([^"]*)"')
+
+
+# Bundles each worker process has open, so members are read without reopening the archive
+_open_bundles = {}
+
+
+def find_dumps(paths):
+    """
+    Yields (name, path, member) for every failure screendump under the given directories and bundles.
+    member is None for loose files, the member name in a zip, and (data offset, size) in a tar.
+    Only names and offsets are yielded; the workers read the contents themselves.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                for filename in filenames:
+                    full_path = os.path.join(root, filename)
+                    if DUMP_NAME_PATTERN.search(filename):
+                        yield (full_path, full_path, None)
+                    elif tarfile.is_tarfile(full_path) or zipfile.is_zipfile(full_path):
+                        for dump in find_dumps([full_path]):
+                            yield dump
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as bundle:
+                for member in bundle.namelist():
+                    if DUMP_NAME_PATTERN.search(member):
+                        yield ("%s:%s"%(path, member), path, member)
+        elif tarfile.is_tarfile(path):
+            with tarfile.open(path) as bundle:
+                for member in bundle:
+                    if member.isfile() and DUMP_NAME_PATTERN.search(member.name):
+                        yield ("%s:%s"%(path, member.name), path, (member.offset_data, member.size))
+        elif DUMP_NAME_PATTERN.search(path):
+            yield (path, path, None)
+
+
+def stage_from_name(name):
+    """
+    The handler names its failure dumps failed_to_<stage>_screendump.txt
+    """
+    match = DUMP_NAME_PATTERN.search(os.path.basename(name))
+    return match.group(1)[len("failed_to_"):] if match.group(1).startswith("failed_to_") else match.group(1)
+
+
+def read_dump(path, member):
+    if member is None:
+        with open(path, "rb") as f:
+            return f.read()
+    if path not in _open_bundles:
+        _open_bundles[path] = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else tarfile.open(path)
+    bundle = _open_bundles[path]
+    if isinstance(bundle, zipfile.ZipFile):
+        return bundle.read(member)
+    offset, size = member
+    bundle.fileobj.seek(offset)
+    return bundle.fileobj.read(size)
+
+
+def extract_features(dump):
+    """
+    Returns (name, stage, features) for one screendump, where features is the set of
+    "text:<clickable text>" and "resource-id:<id>" strings on the screen
+    """
+    name, path, member = dump
+    content = read_dump(path, member).decode("utf-8", "ignore")
+    features = set()
+    for node in NODE_PATTERN.finditer(content):
+        attributes = dict(ATTRIBUTE_PATTERN.findall(node.group(1)))
+        if attributes.get("resource-id"):
+            features.add("resource-id:" + attributes["resource-id"])
+        if attributes.get("clickable") == "true":
+            for attribute in ["text", "content-desc"]:
+                if attributes.get(attribute, "").strip():
+                    features.add("text:" + attributes[attribute].strip().lower())
+    return (name, stage_from_name(name), features)
+
+
+def build_matrix(feature_sets, min_dumps=2):
+    """
+    Builds a binary dumps x features matrix over the features seen in at least min_dumps dumps
+    """
+    counts = {}
+    for features in feature_sets:
+        for feature in features:
+            counts[feature] = counts.get(feature, 0) + 1
+    vocabulary = sorted(feature for feature, count in counts.items() if count >= min_dumps)
+    columns = dict((feature, i) for i, feature in enumerate(vocabulary))
+    matrix = numpy.zeros((len(feature_sets), len(vocabulary)), dtype=numpy.float32)
+    for row, features in enumerate(feature_sets):
+        for feature in features:
+            if feature in columns:
+                matrix[row, columns[feature]] = 1
+    return matrix, vocabulary
+
+
+def cluster(matrix, threshold=0.6, chunk_size=1024):
+    """
+    Leader clustering on cosine similarity: the dump with the most similar neighbours claims them
+    as a cluster, then the next best remaining dump does the same. Returns a cluster label per row,
+    with -1 for dumps that had no usable features.
+    """
+    norms = numpy.sqrt((matrix * matrix).sum(axis=1))
+    normalized = matrix / numpy.maximum(norms, 1e-9)[:, None]
+    degrees = numpy.zeros(len(matrix), dtype=numpy.int64)
+    for start in range(0, len(matrix), chunk_size):
+        similarity = normalized[start:start + chunk_size].dot(normalized.T)
+        degrees[start:start + chunk_size] = (similarity >= threshold).sum(axis=1)
+    labels = numpy.full(len(matrix), -1, dtype=numpy.int64)
+    unassigned = norms > 0
+    label = 0
+    for leader in numpy.argsort(-degrees, kind="mergesort"):
+        if not unassigned[leader]:
+            continue
+        members = unassigned & (normalized.dot(normalized[leader]) >= threshold)
+        members[leader] = True
+        labels[members] = label
+        unassigned[members] = False
+        label += 1
+    return labels
+
+
+def word_boundary(character):
+    """
+    A \\b next to a non-word character can never match, so only bound texts at word characters
+    """
+    return "\\b" if re.match(r"\w", character, re.U) else ""
+
+
+def candidate_selectors(cluster_id, feature_frequency, vocabulary, min_share=0.8):
+    """
+    Turns the features shared by most of a cluster into selectors shaped like popup_selectors
+    """
+    shared = [vocabulary[i] for i in numpy.argsort(-feature_frequency, kind="mergesort")
+        if feature_frequency[i] >= min_share]
+    selectors = {}
+    # one selector per text, so opposite buttons (e.g. allow/deny) stay separate like in popup_selectors
+    texts = [feature[len("text:"):] for feature in shared if feature.startswith("text:")]
+    for i, text in enumerate(texts):
+        selectors["cluster%sText%sSelector"%(cluster_id, i)] = {"clickable": True,
+            "textMatches": ".*(?i)%s%s%s.*"%(word_boundary(text[0]), re.escape(text), word_boundary(text[-1]))}
+    resource_ids = [feature[len("resource-id:"):] for feature in shared if feature.startswith("resource-id:")]
+    for i, resource_id in enumerate(resource_ids):
+        selectors["cluster%sResourceId%sSelector"%(cluster_id, i)] = {"resourceId": resource_id}
+    return selectors
+
+
+def analyze(paths, workers=None, threshold=0.6, min_dumps=2, examples=5):
+    pool = Pool(workers or cpu_count())
+    try:
+        dumps = list(pool.imap_unordered(extract_features, find_dumps(paths), chunksize=64))
+    finally:
+        pool.close()
+        pool.join()
+    dumps.sort(key=lambda dump: dump[0])
+    if not dumps:
+        return []
+    matrix, vocabulary = build_matrix([features for _, _, features in dumps], min_dumps=min_dumps)
+    labels = cluster(matrix, threshold=threshold)
+    report = []
+    for cluster_id in range(labels.max() + 1):
+        rows = numpy.flatnonzero(labels == cluster_id)
+        stages = {}
+        for row in rows:
+            stages[dumps[row][1]] = stages.get(dumps[row][1], 0) + 1
+        report.append({
+            "cluster": cluster_id,
+            "dumps": len(rows),
+            "stages": stages,
+            "examples": [dumps[row][0] for row in rows[:examples]],
+            "popup_selectors": candidate_selectors(cluster_id, matrix[rows].mean(axis=0), vocabulary),
+        })
+    unclustered = numpy.flatnonzero(labels == -1)
+    if len(unclustered):
+        report.append({"cluster": None, "dumps": len(unclustered),
+            "examples": [dumps[row][0] for row in unclustered[:examples]]})
+    return report
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Cluster failure screendumps and suggest popup selectors")
+    parser.add_argument("paths", nargs="+",
+        help="directories and .tar/.tar.gz/.zip bundles containing screendumps")
+    parser.add_argument("-o", "--output", type=str,
+        help="YAML file to write the report to, stdout by default")
+    parser.add_argument("-j", "--workers", type=int,
+        help="number of worker processes, all cores by default")
+    parser.add_argument("--threshold", type=float, default=0.6,
+        help="cosine similarity needed to join a cluster")
+    parser.add_argument("--min-dumps", type=int, dest="min_dumps", default=2,
+        help="ignore features seen in fewer dumps than this")
+    return parser.parse_args(argv[1:])
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    report = analyze(args.paths, workers=args.workers, threshold=args.threshold, min_dumps=args.min_dumps)
+    report.sort(key=lambda entry: -entry["dumps"])
+    if args.output:
+        with open(args.output, "w") as f:
+            yaml.safe_dump(report, f, default_flow_style=False, width=200)
+    else:
+        print(yaml.safe_dump(report, default_flow_style=False, width=200))